@@ -12,164 +12,198 @@
 # Usage: python(.exe) sort_includes.py [-h] path
 # Example: py Tools\sort_includes Application\src
 #
-# Requires Python version 3.4 or higher
+# Requires Python version 3.5 or higher
 # Incompatible with Python 2.x
 #
 # TODO: sort includes inside #if-blocks
 #
 
-from io import StringIO
+import os
+import re
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from argparse import ArgumentParser
 
-files_refactored = 0
-excluded_dirs = [ '.git', '.vscode', 'ASF', 'config', 'lib']
-excluded_files = [ 'asf.h', 'git_version.h', 'aes.c', 'aes.h' ]
-stdlib_includes = [ '<assert.h>', '<complex.h>', '<ctype.h>', '<errno.h>', '<float.h>', '<inttypes.h>', 
-                    '<limits.h>', '<locale.h>', '<math.h>', '<signal.h>', '<stdarg.h>', '<stdbool.h>', 
-                    '<stddef.h>', '<stdint.h>', '<stdio.h>', '<stdlib.h>', '<string.h>', '<time.h>' ]
-
-def dir_excluded(path):
-    for part in path.parts:
-        if part in excluded_dirs:
-            return True
-    return False
+SOURCE_SUFFIXES = ('.c', '.h')
+EXCLUDED_DIRS = frozenset({ '.git', '.vscode', 'ASF', 'config', 'lib' })
+EXCLUDED_FILES = frozenset({ 'asf.h', 'git_version.h', 'aes.c', 'aes.h' })
+STDLIB_HEADER_NAMES = frozenset({ 'assert.h', 'complex.h', 'ctype.h', 'errno.h', 'float.h', 'inttypes.h', 
+                                  'limits.h', 'locale.h', 'math.h', 'signal.h', 'stdarg.h', 'stdbool.h', 
+                                  'stddef.h', 'stdint.h', 'stdio.h', 'stdlib.h', 'string.h', 'time.h' })
 
-def file_excluded(path):
-    if (path.suffix == '.c' or path.suffix == '.h'):
-        return path.name in excluded_files
-    return False
+# Matches the preprocessor directives of interest at the start of a line (#include, #if*, #end*)
+DIRECTIVE_RE = re.compile(rb'#(include|if|end)')
 
-# Recursively get all source files (and headers) inside of the specified folder
-source_file_paths = []
+# Yield all source files (and headers) inside of the specified folder and its subfolders
+# Each file is yielded once: a symlink is yielded as its target, and only if that target was not seen before
 def collect_source_files(folder_path):
-    for path in Path.iterdir(folder_path):
-        if path.is_file() and not file_excluded(path):
-            source_file_paths.append(path.absolute())
-        if path.is_dir() and not dir_excluded(path):
-            collect_source_files(path)
-    return source_file_paths
-
-# Get all lines with an #include directive (excluding those inside of #if directives)
-def collect_include_lines(file_path):
+    seen_paths = set()
+    for root, dirnames, filenames in os.walk(os.path.abspath(str(folder_path))):
+        # Prune excluded directories in-place so they are never descended into
+        dirnames[:] = [d for d in dirnames if d not in EXCLUDED_DIRS]
+        for f in filenames:
+            if f.endswith(SOURCE_SUFFIXES) and f not in EXCLUDED_FILES:
+                # Symlinks to regular files are followed, dangling links and other entries are skipped
+                path = os.path.join(root, f)
+                if not os.path.isfile(path):
+                    continue
+                real_path = os.path.realpath(path)
+                if real_path in seen_paths:
+                    continue
+                seen_paths.add(real_path)
+                yield Path(real_path if os.path.islink(path) else path)
+
+# Get all lines with an #include directive (excluding those inside of #if directives) from the file contents
+def collect_include_lines(data):
     lines = []
     in_if_block = False
-    for line in file_path.open('r'):
-        line = str(line).rstrip()
-        if line.startswith('#include') and not in_if_block:
-            lines.append(line)
-        elif line.startswith('#if'):
+    for line in data.splitlines():
+        match = DIRECTIVE_RE.match(line)
+        if match is None:
+            continue
+        directive = match.group(1)
+        if directive == b'include' and not in_if_block:
+            lines.append(line.rstrip().decode(errors='surrogateescape'))
+        elif directive == b'if':
             in_if_block = True
-        elif line.startswith('#endif') and in_if_block:
+        # Only #endif closes the block here, unlike any #end* in the writer; kept as in the original on purpose
+        elif directive == b'end' and line.startswith(b'#endif') and in_if_block:
             in_if_block = False
     return lines
 
-def sort_lib_includes(file_path, lib_includes):
+def sort_lib_includes(lib_includes):
     lib_includes_stdlib = []
     lib_includes_other = []
 
     for directive in sorted(lib_includes):
-        if any([x in directive for x in stdlib_includes]):
+        header = directive.partition('<')[2].rstrip('>').strip()
+        if header in STDLIB_HEADER_NAMES:
             lib_includes_stdlib.append(directive)
         else:
             lib_includes_other.append(directive)
-    
-    # Add whiteline between stdlib and other library include directives
-    if len(lib_includes_stdlib) > 0 and len(lib_includes_other) > 0:
-        lib_includes_stdlib.append('')
 
-    return lib_includes_stdlib + lib_includes_other
+    return [lib_includes_stdlib, lib_includes_other]
 
-def sort_src_includes(file_path, src_includes):
+def sort_src_includes(suffix, stem, src_includes):
     # Place source header at top
-    if file_path.suffix == '.c':
-        for directive in src_includes:
-            if file_path.stem in directive: # associated header file
-                src_includes.remove(directive)
-                directive = '#include "{}.h"'.format(file_path.stem)  # only use basename
-                if len(src_includes) > 0:
-                     # put directive first and return rest of includes sorted
-                    return [directive, ''] + sorted(src_includes)
-                else:
-                    return [directive]
-    return sorted(src_includes)
-            
-def sort_include_lines(file_path, include_lines):
+    if suffix == '.c':
+        idx = next((i for i, d in enumerate(src_includes) if stem in d), -1)
+        if idx >= 0: # associated header file
+            directive = '#include "{}.h"'.format(stem)  # only use basename
+            # put directive first and rest of includes sorted
+            rest = sorted(d for d in src_includes[:idx] + src_includes[idx + 1:] if d != directive)
+            return [[directive], rest]
+    return [sorted(src_includes)]
+
+def sort_include_lines(file_path, include_lines, data):
+    # Remove duplicates
+    include_lines = list(dict.fromkeys(include_lines))
+
     # Get includes in the form #include <...>
-    lib_includes = [x for x in include_lines if str(x).endswith('>')]
+    lib_includes = [x for x in include_lines if x[-1:] == '>']
 
     # Get includes in the form #include "..."
-    src_includes = [x for x in include_lines if str(x).endswith('\"')] 
-
-    # Custom sorting, remove duplicates
-    lib_includes = list(dict.fromkeys(sort_lib_includes(file_path, lib_includes)))
-    src_includes = list(dict.fromkeys(sort_src_includes(file_path, src_includes)))
-
-    # Buffer to write new file contents to
-    out_buffer = StringIO()
-
-    # Open file for reading and write to buffer
-    with file_path.open('r+') as src_file:
-        file_lines = src_file.readlines()
-        in_if_block = False
-        first_include_line = True
-        first_line_after_include_block = False
-
-        for line in file_lines:
-            line = str(line)
-            if line.startswith('#include'):
-                if first_include_line:
-                    first_include_line = False
-                    first_line_after_include_block = True
-                    
-                    # Dump all the sorted include directives here
-                    for include_line in lib_includes:
-                        out_buffer.write(include_line + '\n')
-                    if len(lib_includes) > 0:
-                        out_buffer.write('\n')
-                    for include_line in src_includes:
-                        out_buffer.write(include_line + '\n')
-                    if len(src_includes) > 0:
-                        out_buffer.write('\n')
-                elif in_if_block: # Write line as-is; #include directives between #if/#endif directives are untouched
-                    out_buffer.write(line)
-            elif not first_include_line and line.startswith('#if'):
-                out_buffer.write(line)
-                in_if_block = True
-                first_line_after_include_block = False
-            elif not first_include_line and line.startswith('#end'):
-                out_buffer.write(line)
-                in_if_block = False
-                first_line_after_include_block = False
-            elif first_line_after_include_block and not line.strip(): # whitespace after #include blocks
-                continue
-            else:
-                out_buffer.write(line)
-                first_line_after_include_block = False
-
-    # Get last line and append newline if necessary
-    out_buffer.seek(out_buffer.tell() - 1)
-    last_line = out_buffer.readline()
-    if '\n' not in last_line:
-        out_buffer.write('\n')
-    out_buffer.truncate()
-
-    with file_path.open('r+') as overwritten_file:
-        overwritten_file.seek(0)
-        print(out_buffer.getvalue(), file=overwritten_file, end='')
-        overwritten_file.truncate()
+    src_includes = [x for x in include_lines if x[-1:] == '"']
+
+    # Custom sorting into groups of include directives
+    include_groups = sort_lib_includes(lib_includes) + sort_src_includes(file_path.suffix, file_path.stem, src_includes)
+
+    # Parts of the new file contents, joined once at the end
+    out_parts = []
+
+    # Collect file contents, keeping the line endings used by the file
+    newline = b'\r\n' if b'\r\n' in data else b'\n'
+    file_lines = data.splitlines(keepends=True)
+    in_if_block = False
+    first_include_line = True
+    first_line_after_include_block = False
+
+    for line in file_lines:
+        match = DIRECTIVE_RE.match(line)
+        directive = match.group(1) if match else None
+        if directive == b'include':
+            if first_include_line:
+                first_include_line = False
+                first_line_after_include_block = True
+                
+                # Dump all the sorted include directives here, with a whiteline after each group
+                for include_group in include_groups:
+                    if len(include_group) > 0:
+                        for include_line in include_group:
+                            out_parts.append(include_line.encode(errors='surrogateescape'))
+                            out_parts.append(newline)
+                        out_parts.append(newline)
+            elif in_if_block: # Write line as-is; #include directives between #if/#endif directives are untouched
+                out_parts.append(line)
+        elif not first_include_line and directive == b'if':
+            out_parts.append(line)
+            in_if_block = True
+            first_line_after_include_block = False
+        elif not first_include_line and directive == b'end':
+            out_parts.append(line)
+            in_if_block = False
+            first_line_after_include_block = False
+        elif first_line_after_include_block and not line.strip(): # whitespace after #include blocks
+            continue
+        else:
+            out_parts.append(line)
+            first_line_after_include_block = False
+
+    # Append newline at end of file if necessary, before joining so the contents are allocated once
+    if len(out_parts) == 0 or not out_parts[-1].endswith(b'\n'):
+        out_parts.append(newline)
+    new_data = b''.join(out_parts)
+
+    # Only write when the contents changed, replacing the file atomically
+    if new_data != data:
+        write_file_atomic(file_path, new_data)
+        return True
+    return False
+
+# Replace the file contents via a sibling temp file; symlinks are resolved so their target is updated
+def write_file_atomic(file_path, data):
+    real_path = os.path.realpath(str(file_path))
+    real_dir, real_name = os.path.split(real_path)
+    fd, tmp_path = tempfile.mkstemp(dir=real_dir, prefix=real_name + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(data)
+        shutil.copymode(real_path, tmp_path)
+        os.replace(tmp_path, real_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+# Sort includes of a single file, returns whether the file was refactored (rewritten)
+def process_one_file(path):
+    # Skip files without any include directives before scanning them line by line
+    data = path.read_bytes()
+    if b'#include' not in data:
+        return False
+    includes = collect_include_lines(data)
+    if len(includes) > 0:
+        return sort_include_lines(path, includes, data)
+    return False
 
+# Sort includes of a file or all source files in a directory, returns the number of files refactored
 def sort_includes(path):
+    files_refactored = 0
     if path.is_file():
-        includes = collect_include_lines(path)
-        if len(includes) > 0:
+        if process_one_file(path):
             print(path)
-            sort_include_lines(path, includes)
-            global files_refactored
             files_refactored += 1
     elif path.is_dir():
-        for file in collect_source_files(path):
-            sort_includes(file)
+        # Files are independent, so they can be processed concurrently without locking
+        with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+            futures = [ (file, executor.submit(process_one_file, file)) for file in collect_source_files(path) ]
+            # Consume results in submission (walk) order so the output is deterministic
+            for file, future in futures:
+                if future.result():
+                    print(file)
+                    files_refactored += 1
+    return files_refactored
 
 def main():
     parser = ArgumentParser(description='Sort #include directives of a source file or source files in a directory')
@@ -181,7 +215,7 @@ def main():
         if not p.exists():
             raise FileNotFoundError(p)
         else:
-            sort_includes(p)
+            files_refactored = sort_includes(p)
             print('Refactored', files_refactored, 'files.')
 
 if __name__ == "__main__":